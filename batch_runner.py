@@ -0,0 +1,190 @@
+'''
+Headless batch runner for bot backtests.
+
+Reads a file of bot definitions, simulates every bot against a price snapshot without the streamlit UI,
+and writes value histories, trade logs and summary metrics to parquet files.
+
+Usage:
+    python batch_runner.py bots.json --prices data/prices.csv --out results/ --jobs 4
+
+A bot definitions file is either a JSON list or a JSON-lines file, with one bot per entry:
+    {"name": "momentum",
+     "strategy": {"type": "RULES", "buy_rule": "consecutive", "buy_period": 2, "buy_signal": 0,
+                  "sell_rule": "hold", "sell_period": 1, "exposure": 0.1},
+     "allocation": {"BTC-USD": 0, "ETH-USD": 0, "USD": 1},
+     "start_date": "2023-01-01",
+     "start_value": 1000}
+buy_rule is 'consecutive' or 'window', and sell_rule is 'hold' or 'reversal'. exposure is the value of each buy
+as a fraction of the portfolio value, so 0.1 buys up to 10% of the portfolio per token.
+start_date and start_value are optional and default to the values used by the Bot Creator page.
+'''
+import argparse
+from collections import Counter
+import json
+import os
+
+import pandas as pd
+from joblib import Parallel, delayed
+
+from crypto_bots_classes import Portfolio, PriceData, StrategyHold, StrategyRules, clean_prices
+from portfolio_analytics import compute_metrics, exposure, traded_value
+
+
+DEFAULT_START_DATE = '2023-01-01'
+DEFAULT_START_VALUE = 1000
+BUY_RULES = ['consecutive', 'window']
+SELL_RULES = ['hold', 'reversal']
+
+
+def load_definitions(path):
+    '''
+    Reads bot definitions from a JSON list or JSON-lines file.
+    '''
+    with open(path) as f:
+        if path.endswith('.jsonl'):
+            definitions = [json.loads(line) for line in f if line.strip()]
+        else:
+            definitions = json.load(f)
+
+    for position, definition in enumerate(definitions):
+        if not isinstance(definition, dict) or 'name' not in definition:
+            raise ValueError(f'Invalid definition for bot number {position + 1} in {path}: every bot needs a name')
+
+    counts = Counter(definition['name'] for definition in definitions)
+    duplicates = sorted(name for name, count in counts.items() if count > 1)
+    if duplicates:
+        raise ValueError(f'Bot names must be unique, found duplicates: {duplicates}')
+    return definitions
+
+
+def load_snapshot(path):
+    '''
+    Loads a price snapshot from csv exactly as the app does, but without triggering a Yahoo Finance update,
+    so repeated batch runs are reproducible.
+    '''
+    data = PriceData(path)
+    if isinstance(data.load_prices(), int):
+        raise FileNotFoundError(f'No price data found at {path}')
+    return clean_prices(data.prices)
+
+
+def build_strategy(spec):
+    '''
+    Creates a strategy object from its definition.
+    spec['type'] is either 'HOLD' or 'RULES'; the remaining keys are passed on to StrategyRules.
+    '''
+    kind = spec.get('type', 'HOLD').upper()
+    if kind == 'HOLD':
+        return StrategyHold()
+    elif kind == 'RULES':
+        if spec['buy_rule'] not in BUY_RULES:
+            raise ValueError(f"Unknown buy_rule: {spec['buy_rule']!r}, expected one of {BUY_RULES}")
+        if spec['sell_rule'] not in SELL_RULES:
+            raise ValueError(f"Unknown sell_rule: {spec['sell_rule']!r}, expected one of {SELL_RULES}")
+        return StrategyRules(spec['buy_rule'], spec['buy_period'], spec.get('buy_signal', 0),
+                             spec['sell_rule'], spec['sell_period'], spec['exposure'])
+    raise ValueError(f"Unknown strategy type: {spec.get('type')}")
+
+
+def build_bot(definition, prices):
+    '''
+    Creates an unsimulated Portfolio object from a bot definition.
+    '''
+    try:
+        return Portfolio(definition['name'],
+                         definition['allocation'],
+                         definition.get('start_date', DEFAULT_START_DATE),
+                         definition.get('start_value', DEFAULT_START_VALUE),
+                         prices,
+                         build_strategy(definition.get('strategy', {})))
+    except (AssertionError, KeyError, ValueError) as e:
+        raise ValueError(f"Invalid definition for bot '{definition.get('name')}': {e!r}") from e
+
+
+def run_bot(bot, prices):
+    '''
+    Simulates a single bot up to the end of the price snapshot.
+    Returns the bot's value history, trade log and a dictionary of summary metrics.
+    '''
+    bot.new_simulate_update(prices, verbose=False)
+
+    history = bot.value_history().rename('value').rename_axis('date').reset_index()
+    history.insert(0, 'bot', bot.name)
+
+    trades = bot.trades_log.rename_axis('trade_id').reset_index()
+    trades.insert(0, 'bot', bot.name)
+
+    metrics = {'bot': bot.name,
+               'strategy': bot.strategy.description,
+               'start_date': bot.holdings.index[0].date(),
+               'start_value': bot.start_value,
+               'final_value': bot.valuate(),
+               'total_return': round(bot.valuate() - bot.start_value, 2),
+               'days_held': len(bot.holdings.index),
+               'roi': bot.roi(),
+               'volatility': round(bot.volatility(), 2),
+               'trades': bot.trades_log.shape[0],
+               'not_enough_cash': bot.error_log['not enough cash'],
+               'traded_value': traded_value(bot),
+               'exposure': exposure(bot).mean()}
+    return history, trades, metrics
+
+
+def run_batch(definitions, prices, n_jobs=1):
+    '''
+    Simulates all defined bots, spread over n_jobs worker processes (-1 uses all cores).
+    Returns the combined value histories, trade logs and metrics as DataFrames.
+    '''
+    bots = [build_bot(definition, prices) for definition in definitions]
+    results = Parallel(n_jobs=n_jobs)(delayed(run_bot)(bot, prices) for bot in bots)
+
+    histories, trades, metrics = zip(*results) if results else ([], [], [])
+    histories = pd.concat(histories, ignore_index=True) if histories else pd.DataFrame(columns=['bot', 'date', 'value'])
+    trades = pd.concat([t for t in trades if t.shape[0] > 0] or [pd.DataFrame(columns=['bot', 'trade_id'])], ignore_index=True)
+    # dates are python date objects in the trade log, which parquet can't store in a column with NaT
+    for col in ['buy_date', 'sell_date']:
+        if col in trades.columns:
+            trades[col] = pd.to_datetime(trades[col])
+    metrics = pd.DataFrame(list(metrics), columns=['bot', 'strategy', 'start_date', 'start_value', 'final_value',
+                                                   'total_return', 'days_held', 'roi', 'volatility', 'trades',
+                                                   'not_enough_cash', 'traded_value', 'exposure'])
+    metrics['start_date'] = pd.to_datetime(metrics['start_date'])
+
+    # risk metrics for all bots in one pass over their combined value histories
+    risk = compute_metrics(histories.pivot(index='date', columns='bot', values='value'),
+                           start_values=metrics.set_index('bot')['start_value'],
+                           traded=metrics.set_index('bot')['traded_value'])
+    risk = risk[['sharpe', 'sortino', 'max_drawdown', 'max_drawdown_days', 'turnover']]
+    metrics = metrics.drop(columns='traded_value').merge(risk, left_on='bot', right_index=True, how='left')
+    return histories, trades, metrics
+
+
+def write_results(out_dir, histories, trades, metrics):
+    '''
+    Writes batch results to out_dir as values.parquet, trades.parquet and metrics.parquet.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    histories.to_parquet(os.path.join(out_dir, 'values.parquet'), index=False)
+    trades.to_parquet(os.path.join(out_dir, 'trades.parquet'), index=False)
+    metrics.to_parquet(os.path.join(out_dir, 'metrics.parquet'), index=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run bot backtests without the streamlit UI.')
+    parser.add_argument('definitions', help='JSON or JSON-lines file of bot definitions')
+    parser.add_argument('--prices', default='data/prices.csv', help='price snapshot csv (default: data/prices.csv)')
+    parser.add_argument('--out', default='results', help='output directory for parquet files (default: results)')
+    parser.add_argument('--jobs', type=int, default=1, help='number of worker processes, -1 for all cores (default: 1)')
+    args = parser.parse_args(argv)
+
+    prices = load_snapshot(args.prices)
+    definitions = load_definitions(args.definitions)
+    print(f'Simulating {len(definitions)} bots from {args.definitions} with {args.jobs} job(s)')
+
+    histories, trades, metrics = run_batch(definitions, prices, n_jobs=args.jobs)
+    write_results(args.out, histories, trades, metrics)
+    print(f'Results written to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
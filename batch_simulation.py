@@ -0,0 +1,262 @@
+'''
+Batched simulation core.
+
+Simulates many bots on many price paths at once, as array computations over (paths, bots, tokens).
+Days are stepped through in Python, but trades never are: all sells and buys of a day are executed for the
+whole batch in a few vectorized operations, including any trading costs from a CostModel.
+The trading rules are the ones of Portfolio.new_simulate_update with StrategyHold and StrategyRules, and trades are
+executed in the same order as by Portfolio (buys in allocation order, sells in purchase or allocation order), so results
+match a Portfolio simulation up to floating point rounding of the daily totals. Only daily total values and trade totals are kept,
+rather than full holdings tables and trade logs.
+'''
+import numpy as np
+
+from crypto_bots_classes import StrategyRules
+
+
+BUY_RULES = {'consecutive': 0, 'window': 1}
+SELL_RULES = {'hold': 0, 'reversal': 1}
+
+
+def strategy_arrays(strategies):
+    '''
+    Parameters of a list of StrategyHold and StrategyRules objects as arrays with one entry per strategy.
+    Rules are encoded with BUY_RULES and SELL_RULES; HOLD strategies get rule code -1.
+    '''
+    rules = [strategy if isinstance(strategy, StrategyRules) else None for strategy in strategies]
+    return {'buy_rule': np.array([BUY_RULES[s.buy_rule] if s else -1 for s in rules], dtype=int),
+            'buy_period': np.array([s.buy_period if s else 0 for s in rules], dtype=int),
+            'buy_signal': np.array([s.buy_signal if s else 0 for s in rules], dtype=float),
+            'sell_rule': np.array([SELL_RULES[s.sell_rule] if s else -1 for s in rules], dtype=int),
+            'sell_period': np.array([s.sell_period if s else 0 for s in rules], dtype=int),
+            'exposure': np.array([s.exposure if s else 0 for s in rules], dtype=float)}
+
+
+class CostModel():
+    '''
+    Trading costs applied to every buy and sell of simulate_batch.
+    Each parameter is either one number for all bots, or an array with one value per bot, so cost assumptions
+    can be swept in the same batch as any other bot parameter.
+
+    fixed_fee: USD charged per trade
+    fee_rate: fee as a fraction of the traded value
+    spread: bid-ask spread as a fraction of the price; buys fill half a spread above the daily close, sells half a spread below
+    slippage: additional price impact, as a fraction of the price, of trading `liquidity` USD at once.
+              Impact scales linearly with the size of each trade, so large trades fill worse than small ones.
+    liquidity: trade size in USD at which the price impact equals `slippage`
+
+    A buy always takes its full value from cash, and fees and price impact reduce the amount of tokens it gets.
+    A sell's proceeds are reduced by price impact and fees, and never drop below 0.
+    '''
+    def __init__(self, fixed_fee=0, fee_rate=0, spread=0, slippage=0, liquidity=1e6):
+        self.fixed_fee = fixed_fee
+        self.fee_rate = fee_rate
+        self.spread = spread
+        self.slippage = slippage
+        self.liquidity = liquidity
+
+    def for_batch(self, n_bots):
+        '''
+        Copy of the cost model with every parameter as an array broadcast against (paths, bots, tokens).
+        '''
+        def per_bot(value):
+            return np.broadcast_to(np.asarray(value, dtype=float), (n_bots,))[None, :, None]
+        return CostModel(per_bot(self.fixed_fee), per_bot(self.fee_rate), per_bot(self.spread),
+                         per_bot(self.slippage), per_bot(self.liquidity))
+
+    def sell_proceeds(self, gross):
+        '''
+        Cash received for selling tokens worth `gross` USD at the daily close, before flooring to whole cents.
+        '''
+        fill = gross * (1 - self.spread / 2 - self.slippage * gross / self.liquidity)
+        return np.maximum(fill * (1 - self.fee_rate) - self.fixed_fee, 0)
+
+    def buy_fill(self, value, price):
+        '''
+        Cash left to buy tokens with after fees, and the price it buys them at, for `value` USD at a daily close of `price`.
+        '''
+        fill_price = price * (1 + self.spread / 2 + self.slippage * value / self.liquidity)
+        return np.maximum(value * (1 - self.fee_rate) - self.fixed_fee, 0), fill_price
+
+    def buy_amount(self, value, price):
+        '''
+        Amount of tokens bought for `value` USD of cash at a daily close of `price`.
+        '''
+        net, fill_price = self.buy_fill(value, price)
+        return net / fill_price
+
+    def buy_cost(self, value, price):
+        '''
+        Cost of buying for `value` USD: the cash paid minus the value of the tokens received at the daily close.
+        Computed from the price ratio rather than the token amount, so it is exactly 0 without costs.
+        '''
+        net, fill_price = self.buy_fill(value, price)
+        return value - net * (price / fill_price)
+
+
+def streaks(prices, rising=True):
+    '''
+    For an array of prices (paths, days, tokens), the number of consecutive days up to and including each day
+    on which the price went up (or down, if rising=False).
+    '''
+    moved = prices[:, 1:] > prices[:, :-1] if rising else prices[:, 1:] < prices[:, :-1]
+    moved = np.concatenate([np.zeros_like(moved[:, :1]), moved], axis=1)
+    days = np.arange(prices.shape[1])[None, :, None]
+    last_still = np.maximum.accumulate(np.where(moved, 0, days), axis=1)
+    return (days - last_still).astype(np.int32)
+
+
+def simulate_batch(prices, start, strategies, allocations, tokens, start_values, gaps=None, costs=None):
+    '''
+    Simulates every bot on every price path from day `start` to the last day.
+
+    inputs
+    prices: array (paths, days, tokens) of token prices, excluding USD. Days before start are used as history by the rules.
+    start: index of the start day in prices
+    strategies: list of StrategyHold or StrategyRules objects, one per bot
+    allocations: list of initial_split dictionaries, one per bot, as passed to Portfolio. Only tokens in a bot's allocation are traded,
+                 in the order they appear in it.
+    tokens: token names of the last axis of prices
+    start_values: start value per bot, or one start value for all bots
+    gaps: optional array with the number of calendar days between each day and the one before it, see PriceIndex.day_gaps
+    costs: optional CostModel. Without one, trades fill at the daily close without fees, as in Portfolio.
+
+    returns
+    a dictionary of arrays with a (paths, bots) shape, except for
+    values: daily total value (paths, bots, days from start), unrounded
+    holdings: final token holdings (paths, bots, tokens)
+    '''
+    n_paths, n_days, n_tokens = prices.shape
+    n_bots = len(strategies)
+    params = strategy_arrays(strategies)
+    gaps = np.ones(n_days, dtype=int) if gaps is None else gaps
+    costs = None if costs is None else costs.for_batch(n_bots)
+
+    token_pos = {token: i for i, token in enumerate(tokens)}
+    split = np.zeros((n_bots, n_tokens))
+    usd_split = np.zeros(n_bots)
+    allowed = np.zeros((n_bots, n_tokens), dtype=bool)
+    # rank of each token in a bot's allocation, the order in which Portfolio trades them; other tokens come after
+    rank = np.zeros((n_bots, n_tokens), dtype=int)
+    for bot, allocation in enumerate(allocations):
+        assert round(sum(allocation.values()), 2) == 1, 'initial_split must add up to 1'
+        for token, share in allocation.items():
+            if token == 'USD':
+                usd_split[bot] = share
+            else:
+                split[bot, token_pos[token]] = share
+                allowed[bot, token_pos[token]] = True
+        ordered = [token_pos[token] for token in allocation if token != 'USD']
+        ordered += [i for i in range(n_tokens) if i not in ordered]
+        rank[bot, ordered] = np.arange(n_tokens)
+    # positions of the tokens in trading order, and back
+    trade_order = np.argsort(rank, axis=1)[None]
+    rank = rank[None]
+    start_values = np.broadcast_to(np.asarray(start_values, dtype=float), (n_bots,))
+
+    # parameters broadcast against (paths, bots, tokens)
+    exposure = params['exposure'][None, :]
+    buy_period = params['buy_period'][None, :, None]
+    buy_signal = params['buy_signal'][None, :, None]
+    sell_period = params['sell_period'][None, :, None]
+    consecutive = (params['buy_rule'] == BUY_RULES['consecutive'])[None, :, None]
+    window = (params['buy_rule'] == BUY_RULES['window'])[None, :, None]
+    hold = (params['sell_rule'] == SELL_RULES['hold'])[None, :, None]
+    reversal = (params['sell_rule'] == SELL_RULES['reversal'])[None, :, None]
+    rising = streaks(prices, rising=True) if consecutive.any() else None
+    falling = streaks(prices, rising=False) if reversal.any() else None
+
+    holdings = (split * start_values[:, None])[None] / prices[:, start, None, :]
+    cash = np.tile(usd_split * start_values, (n_paths, 1))
+    # days each bought token has been held, -1 when not held through a buy
+    duration = np.full((n_paths, n_bots, n_tokens), -1, dtype=int)
+    # order in which held tokens were bought; hold rule sells are executed in this order, as in Portfolio.hold_duration
+    bought_sequence = np.zeros((n_paths, n_bots, n_tokens), dtype=np.int64)
+    values = np.empty((n_paths, n_bots, n_days - start))
+    values[:, :, 0] = np.nansum(holdings * prices[:, start, None, :], axis=-1) + cash
+    buys_made = np.zeros((n_paths, n_bots), dtype=int)
+    sells_made = np.zeros((n_paths, n_bots), dtype=int)
+    traded_value = np.zeros((n_paths, n_bots))
+    costs_paid = np.zeros((n_paths, n_bots))
+    not_enough_cash = np.zeros((n_paths, n_bots), dtype=int)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for day in range(start + 1, n_days):
+            price = prices[:, day, None, :]
+            duration = np.where(duration >= 0, duration + gaps[day], -1)
+
+            # the strategy decides on the day's sells and buys together, before any of them are executed
+            sell = hold & (duration >= 0) & (duration >= sell_period)
+            if falling is not None:
+                sell |= reversal & (holdings > 0) & (falling[:, day, None, :] >= sell_period)
+
+            signal = np.zeros((n_paths, n_bots, n_tokens), dtype=bool)
+            if rising is not None:
+                signal |= consecutive & (rising[:, day, None, :] >= buy_period)
+            if window.any():
+                back = day - params['buy_period']
+                past = prices[:, np.maximum(back, 0), :]
+                change = (prices[:, day, None, :] - past) / past
+                signal |= window & (back >= 0)[None, :, None] & (change > buy_signal)
+            buys = signal & allowed[None] & (duration < 0)
+            n_buys = buys.sum(axis=-1)
+
+            # portfolio value at the end of the previous day, rounded as by Portfolio.valuate
+            value_before = np.round(values[:, :, day - start - 1], 2)
+            value = np.where(cash < value_before * exposure * n_buys,
+                             np.floor(cash / n_buys * 100) / 100.0,
+                             np.floor(value_before * exposure * 100) / 100.0)
+            buys &= ((cash >= 1) & (n_buys > 0))[..., None]
+
+            # selling
+            # proceeds are added to cash one token at a time, in the order Portfolio.execute_sell is called:
+            # purchase order for the hold rule, allocation order for the reversal rule
+            if costs is None:
+                sold = np.where(sell, np.floor(holdings * price * 100) / 100.0, 0)
+            else:
+                gross = np.where(sell, holdings * price, 0)
+                sold = np.where(sell, np.floor(costs.sell_proceeds(gross) * 100) / 100.0, 0)
+                costs_paid += (np.floor(gross * 100) / 100.0 - sold).sum(axis=-1)
+            sell_order = np.argsort(np.where(hold, bought_sequence, rank), axis=-1, kind='stable')
+            sold_in_order = np.take_along_axis(sold, sell_order, axis=-1)
+            cash = np.add.accumulate(np.concatenate([cash[..., None], sold_in_order], axis=-1), axis=-1)[..., -1]
+            holdings = np.where(sell, 0, holdings)
+            duration = np.where(sell, -1, duration)
+            sells_made += sell.sum(axis=-1)
+            traded_value += sold.sum(axis=-1)
+
+            # buying
+            # buys are paid for in allocation order, so the cash left before each buy is a running subtraction
+            buys_in_order = np.take_along_axis(buys, np.broadcast_to(trade_order, buys.shape), axis=-1)
+            spend = np.where(buys_in_order, value[..., None], 0)
+            cash_left = np.subtract.accumulate(np.concatenate([cash[..., None], spend], axis=-1), axis=-1)
+            filled_in_order = buys_in_order & (value[..., None] <= cash_left[..., :-1])
+            failed_in_order = buys_in_order & ~filled_in_order
+            # once a buy fails for lack of cash, every later buy of the day fails too
+            cash = np.where(failed_in_order.any(axis=-1),
+                            np.take_along_axis(cash_left, np.argmax(failed_in_order, axis=-1)[..., None], axis=-1)[..., 0],
+                            cash_left[..., -1])
+            filled = np.take_along_axis(filled_in_order, np.broadcast_to(rank, buys.shape), axis=-1)
+            failed = buys & ~filled
+            if costs is None:
+                bought = value[..., None] / price
+            else:
+                bought = costs.buy_amount(value[..., None], price)
+                costs_paid += np.where(filled, costs.buy_cost(value[..., None], price), 0).sum(axis=-1)
+            holdings = np.where(filled, holdings + bought, holdings)
+            duration = np.where(filled, 0, duration)
+            bought_sequence = np.where(filled, day * n_tokens + rank, bought_sequence)
+            buys_made += filled.sum(axis=-1)
+            not_enough_cash += failed.sum(axis=-1)
+            traded_value += value * filled.sum(axis=-1)
+
+            values[:, :, day - start] = np.nansum(holdings * price, axis=-1) + cash
+
+    return {'values': values,
+            'holdings': holdings,
+            'cash': cash,
+            'buys': buys_made,
+            'sells': sells_made,
+            'traded_value': traded_value,
+            'costs': costs_paid,
+            'not_enough_cash': not_enough_cash}
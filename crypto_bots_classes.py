@@ -1,6 +1,9 @@
 import glob
 from datetime import datetime
 import math
+import os
+import weakref
+import joblib
 import numpy as np
 import pandas as pd
 
@@ -12,6 +15,14 @@ yf.pdr_override()
 from pandas_datareader import data as wb
 
 
+# Memory-lean mode: price data and prebuilt bots are loaded once per server process and shared read-only between sessions,
+# and simulated bots get sparse holdings before being kept in session state. Set BUILD_A_BOT_LEAN_MEMORY=0 to disable.
+LEAN_MEMORY = os.environ.get('BUILD_A_BOT_LEAN_MEMORY', '1') != '0'
+# Optionally also store value histories as float32, which halves their memory but can move daily values by a cent.
+# Set BUILD_A_BOT_FLOAT32=1 to enable.
+FLOAT32_VALUES = os.environ.get('BUILD_A_BOT_FLOAT32', '0') == '1'
+
+
 class YahooInterface():
     '''
     Interface class to process Yahoo Finance API calls. 
@@ -114,7 +125,88 @@ class PriceData():
 
         print(f'Writing to filepath: {self.filepath}')
         self.prices.to_csv(self.filepath, header=True)
-        
+
+
+class PriceIndex():
+    '''
+    Integer calendar and token index for a price snapshot.
+    Maps dates and tokens to row and column positions once, and keeps the prices as a plain numpy array,
+    so simulations can do positional reads instead of label-based pandas lookups on every trade.
+    Consecutive rows are consecutive trading days in the snapshot, whether or not calendar days are missing in between.
+    Use PriceIndex.of(prices) to reuse the index already built for the same prices DataFrame, which should be treated as read-only.
+    '''
+    _cache = {}
+
+    def __init__(self, prices):
+        self.dates = prices.index
+        self.tokens = prices.columns
+        self.array = prices.to_numpy(dtype=float)
+        self.date_pos = {date: i for i, date in enumerate(self.dates)}
+        self.token_pos = {token: i for i, token in enumerate(self.tokens)}
+
+    @classmethod
+    def of(cls, prices):
+        key = id(prices)
+        cached = cls._cache.get(key)
+        if cached is None or cached[0]() is not prices:
+            cached = (weakref.ref(prices), cls(prices))
+            cls._cache[key] = cached
+            weakref.finalize(prices, cls._cache.pop, key, None)
+        return cached[1]
+
+    def date_loc(self, date):
+        try:
+            return self.date_pos[pd.Timestamp(date)]
+        except KeyError:
+            raise KeyError(f'{date} not found in price data') from None
+
+    def token_locs(self, tokens):
+        return np.array([self.token_pos[token] for token in tokens], dtype=int)
+
+    def day_gaps(self):
+        '''
+        Number of calendar days between each trading day and the one before it. The first entry is 0.
+        '''
+        return np.concatenate([[0], np.diff(self.dates.values).astype('timedelta64[D]').astype(int)])
+
+
+class SimulationState():
+    '''
+    State of a portfolio on the day being simulated by Portfolio.new_simulate_update, as returned by
+    Portfolio.simulation_state(). The portfolio's holdings and values DataFrames are only written back once the
+    simulation ends, so strategies read the current state from here instead.
+
+    columns: dictionary of holdings column (token or 'USD') to its position in the arrays below
+    prices: array (trading days, columns) of the simulated prices, row `day` being the day being simulated
+    holdings_history, values_history: arrays (rows, columns) of holdings and values, row `row` being the day being simulated.
+                                      Today's values row is only filled in after the day's trades.
+    trades: trade log records, as in Portfolio.trades_log
+    date, day, row: date of the day being simulated, and its row in prices and in the history arrays
+    '''
+    def __init__(self, columns, prices, n_rows):
+        self.columns = {col: i for i, col in enumerate(columns)}
+        self.prices = prices
+        self.holdings_history = np.empty((n_rows, len(columns)))
+        self.values_history = np.empty((n_rows, len(columns)))
+        self.trades = []
+        self.date, self.day, self.row = None, None, None
+
+    @property
+    def holdings(self):
+        '''
+        Holdings of the day being simulated, updated in place as trades are executed.
+        '''
+        return self.holdings_history[self.row]
+
+    def coins(self):
+        return [col for col in self.columns if col != 'USD']
+
+    def previous_value(self):
+        '''
+        Total portfolio value at the end of the previous day, rounded as by Portfolio.valuate.
+        '''
+        return round(float(np.nansum(self.values_history[self.row - 1])), 2)
+
 
 class Portfolio():
 
@@ -134,30 +226,61 @@ class Portfolio():
         if 'USD' not in self.initial_split.keys():
             self.initial_state['USD'] = 0
         
+        index = PriceIndex.of(prices)
+        start = index.date_loc(start_date)
         for token in self.initial_split.keys():
-            self.initial_state[token] = (self.initial_split[token]*self.start_value)/(prices.loc[start_date, token])
+            self.initial_state[token] = (self.initial_split[token]*self.start_value)/(index.array[start, index.token_pos[token]])
 
 
-        self.holdings = pd.DataFrame.from_dict({k: [v] for k,v in self.initial_state.items()}) 
-        self.holdings.index = pd.date_range(start=start_date, end=start_date)  
-        self.values = prices.loc[self.holdings.index, self.holdings.columns] * self.holdings.loc[:, self.holdings.columns]
+        self.holdings = pd.DataFrame.from_dict({k: [v] for k,v in self.initial_state.items()})
+        self.holdings.index = index.dates[start:start+1]
+        self.values = pd.DataFrame(index.array[start:start+1, index.token_locs(self.holdings.columns)] * self.holdings.to_numpy(dtype=float),
+                                   index=self.holdings.index, columns=self.holdings.columns)
         self.name = name
         self.hold_duration = {}
 
     def valuate(self):
-        return round(self.values.sum(axis=1).iloc[-1], 2)
+        # while simulating, the value at the end of the previous day, as the values table hasn't been written back yet
+        if getattr(self, '_state', None) is not None:
+            return self._state.previous_value()
+        return round(float(self.values.sum(axis=1).iloc[-1]), 2)
     
     def value_history(self):
-        return round(self.values.sum(axis=1), 2)
+        # sum and round in float64, so values compacted to float32 don't show float32 rounding noise in the returned cents
+        return round(self.values.astype(float).sum(axis=1), 2)
     
     def roi(self):
-        annualised = ((self.values.sum(axis=1).iloc[-1] / self.start_value)**(365/len(self.holdings.index))-1)
+        annualised = ((float(self.values.sum(axis=1).iloc[-1]) / self.start_value)**(365/len(self.holdings.index))-1)
         return round(annualised*100, 2)
     
     def volatility(self):
         daily_prop_change = (self.value_history() - self.value_history().shift()) / self.value_history().shift()
         return (daily_prop_change*100).std()
     
+    def compact(self, float32=False, sparse=None):
+        '''
+        Shrinks the memory held by a simulated portfolio.
+        float32: store the value history as float32 instead of float64. This loses precision: value_history()
+                 can differ by a cent on some days.
+        sparse: store holdings with a sparse dtype, where zero holdings take no memory.
+                If None, holdings are made sparse when fewer than half of their entries are non-zero,
+                which is the case for rules-based strategies that only hold a few tokens at a time.
+        Simulating the portfolio further converts both back to dense float64.
+        '''
+        if float32:
+            self.values = self.values.astype(np.float32)
+        if sparse is None:
+            sparse = np.count_nonzero(self.holdings.to_numpy(dtype=float)) < 0.5*self.holdings.size
+        if sparse:
+            self.holdings = self.holdings.astype(pd.SparseDtype(float, 0))
+        return self
+
+    def memory_usage(self):
+        '''
+        Bytes held by the holdings, values and trades_log DataFrames.
+        '''
+        return int(sum(df.memory_usage(deep=True).sum() for df in [self.holdings, self.values, self.trades_log]))
+
     def summary(self):
         print(f'Start value:   {self.start_value}\n'
               f'Current value: {self.valuate()}\n'
@@ -167,55 +290,104 @@ class Portfolio():
               f'Volatility:    {self.volatility()}')
         return 
 
+    def simulation_state(self):
+        '''
+        Returns the SimulationState of the day being simulated. Only available while new_simulate_update runs,
+        so strategies and the execute_ methods can read the portfolio's current state.
+        '''
+        state = getattr(self, '_state', None)
+        if state is None:
+            raise RuntimeError(f'{self.name} is not being simulated; its simulation state is only available during new_simulate_update')
+        return state
+
     def execute_sell(self, coin, date, prices):
-        value = math.floor(self.holdings.loc[date, coin]*prices.loc[date, coin]*100)/100.0
-        self.holdings.loc[date, 'USD'] += value
-        self.holdings.loc[date, coin] = 0
+        state = self.simulation_state()
+        holdings = state.holdings
+        col = state.columns[coin]
+        value = math.floor(holdings[col]*state.prices[state.day, col]*100)/100.0
+        holdings[state.columns['USD']] += value
+        holdings[col] = 0
         #print(f'Sold {coin} worth: {value}') 
         self.hold_duration.pop(coin)
         if coin[:-4] in self.live_positions.keys():
-            self.trades_log.loc[self.live_positions[coin[:-4]]['index'], ['sell_date', 'sell_value', 'profit']] = (date.date(), value, value-self.trades_log.loc[self.live_positions[coin[:-4]]['index'], 'buy_value'])
+            trade = state.trades[self.live_positions[coin[:-4]]['index']]
+            trade.update({'sell_date': date.date(), 'sell_value': value, 'profit': value-trade['buy_value']})
         return
 
     def execute_buy(self, coin, value, date, prices):
-        if value > self.holdings.loc[date, 'USD']:
+        state = self.simulation_state()
+        holdings = state.holdings
+        usd = state.columns['USD']
+        if value > holdings[usd]:
             #print('Not enough cash available')
             self.error_log['not enough cash'] += 1
             return
         else:
-            self.holdings.loc[date, 'USD'] = self.holdings.loc[date, 'USD'] - value
-            self.holdings.loc[date, coin] = self.holdings.loc[date, coin] + (value/prices.loc[date, coin])
+            col = state.columns[coin]
+            amount = value/state.prices[state.day, col]
+            holdings[usd] = holdings[usd] - value
+            holdings[col] = holdings[col] + amount
             #print(f'bought {coin} worth: {value}')
             self.hold_duration[coin] = 0
-            self.trades_log = pd.concat([self.trades_log, pd.DataFrame({'buy_date':[date.date()], 'coin':[coin[:-4]], 'amount':[value/prices.loc[date, coin]], 'buy_value':[value], 'sell_date':[pd.NaT], 'sell_value':[np.nan], 'profit':[np.nan]}, index = [self.trade_id])])
-            self.live_positions[coin[:-4]] = {'index':self.trade_id, 'amount':[value/prices.loc[date, coin]]}
+            state.trades.append({'buy_date':date.date(), 'coin':coin[:-4], 'amount':amount, 'buy_value':value, 'sell_date':pd.NaT, 'sell_value':np.nan, 'profit':np.nan})
+            self.live_positions[coin[:-4]] = {'index':self.trade_id, 'amount':[amount]}
             self.trade_id += 1
             return     
     
-    def new_simulate_update(self, prices):
-
-        for date in pd.date_range(start=self.holdings.index[-1]+pd.DateOffset(days=1), end=prices.index[-1] ):
-            #print(date)
-            # new row in holdings table
-            self.holdings.loc[date, :] = self.holdings.loc[date-pd.DateOffset(days=1), :]
-            # increment hold_durations
-            self.hold_duration = {k: v+1 for k,v in self.hold_duration.items()}
-            #print(self.hold_duration)
-            
-            # consult strategy
-            # strategy returns list of sell trades as strings 'coin'
-            # strategy returns list of buy trades as tuples (coin, value)
-            sell_trades, buy_trades = self.strategy.think(self, date, prices)
-            # execute trades
-            for trade in sell_trades:
-                self.execute_sell(trade, date, prices)
-            for trade in buy_trades:
-                self.execute_buy(*trade, date, prices)
-
-            # new row in values table
-            self.values.loc[date, :] = prices.loc[date, self.holdings.columns] * self.holdings.loc[date, :]
+    def new_simulate_update(self, prices, verbose=True):
+        '''
+        Simulates the portfolio from the day after its last holdings row up to the last date in prices.
+        Holdings, values and trades are kept in a SimulationState while simulating, addressed by integer positions
+        from the PriceIndex of prices, and written back to the holdings, values and trades_log DataFrames at the end.
+        Days missing from prices are skipped, and hold durations advance by the number of calendar days between trading days.
+        '''
+        index = PriceIndex.of(prices)
+        dates = index.dates
+        start = index.date_loc(self.holdings.index[-1]) + 1
+        n_old = len(self.holdings.index)
+        n_new = len(dates) - start
+        gaps = index.day_gaps()
+
+        columns = self.holdings.columns
+        state = SimulationState(columns, index.array[:, index.token_locs(columns)], n_old + n_new)
+        state.holdings_history[:n_old] = self.holdings.to_numpy(dtype=float)
+        state.values_history[:n_old] = self.values.to_numpy(dtype=float)
+        state.trades = self.trades_log.to_dict('records')
+        self._state = state
 
-        print(self.error_log)
+        try:
+            for step in range(n_new):
+                state.row = n_old + step
+                state.day = start + step
+                state.date = date = dates[state.day]
+                # new row in holdings table
+                state.holdings_history[state.row] = state.holdings_history[state.row - 1]
+                # increment hold_durations
+                self.hold_duration = {k: v+gaps[state.day] for k,v in self.hold_duration.items()}
+                
+                # consult strategy
+                # strategy returns list of sell trades as strings 'coin'
+                # strategy returns list of buy trades as tuples (coin, value)
+                sell_trades, buy_trades = self.strategy.think(self, date, prices)
+                # execute trades
+                for trade in sell_trades:
+                    self.execute_sell(trade, date, prices)
+                for trade in buy_trades:
+                    self.execute_buy(*trade, date, prices)
+
+                # new row in values table
+                state.values_history[state.row] = state.prices[state.day] * state.holdings
+        finally:
+            del self._state
+
+        new_index = self.holdings.index.append(dates[start:])
+        self.holdings = pd.DataFrame(state.holdings_history, index=new_index, columns=columns)
+        self.values = pd.DataFrame(state.values_history, index=new_index, columns=columns)
+        if state.trades:
+            self.trades_log = pd.DataFrame.from_records(state.trades, index=range(len(state.trades)))
+
+        if verbose:
+            print(self.error_log)
 
 
 class StrategyHold():
@@ -245,52 +417,77 @@ class StrategyRules():
         return
 
     def think(self, portfolio, date, prices):
+        '''
+        Decides the trades of the day being simulated by Portfolio.new_simulate_update.
+        The portfolio's state and the prices are read from portfolio.simulation_state(), which holds the positional
+        arrays of the `prices` DataFrame being simulated; portfolio.holdings is only updated once the simulation ends.
+
+        returns
+        a list of coins to sell, and a list of (coin, value) tuples to buy
+        '''
+        state = portfolio.simulation_state()
+        holdings = state.holdings
+        usd = state.columns['USD']
+        coins = state.coins()
         
         # selling
         if self.sell_rule == 'hold':
             sell_trades = [coin for coin in portfolio.hold_duration if portfolio.hold_duration[coin] >= self.sell_period]
         
         elif self.sell_rule == 'reversal':
-            candidates = [coin for coin in portfolio.holdings.iloc[-1].index if portfolio.holdings.iloc[-1].loc[coin] > 0 and coin != 'USD']
-            subset = prices.loc[:, candidates]
-            requirements = []
-            for i in range(self.sell_period):
-                requirements.append(subset.shift(i)<subset.shift(i+1))
-                candidates = subset.columns[np.where((sum(requirements) == self.sell_period)
-                                                 .loc[portfolio.holdings.index[-1], :])]
-            sell_trades = candidates
+            candidates = [coin for coin in coins if holdings[state.columns[coin]] > 0]
+            falling = self.streak(state.prices, state.day, self.sell_period, rising=False)
+            sell_trades = [coin for coin in candidates if falling[state.columns[coin]]]
 
         # buying
         buy_trades = []
-        subset = prices.loc[:, portfolio.holdings.columns.drop('USD')]
         if self.buy_rule == 'consecutive':
             # if up x days and if not already holding
-            requirements = []
-            for i in range(self.buy_period):
-                requirements.append(subset.shift(i)>subset.shift(i+1))
-            candidates = subset.columns[np.where((sum(requirements) == self.buy_period)
-                                                 .loc[portfolio.holdings.index[-1], :])]
-
+            signal = self.streak(state.prices, state.day, self.buy_period, rising=True)
             
         elif self.buy_rule == 'window':
             # if up x amount in y days and not already holding
-            candidates = subset.columns[np.where((((subset - subset.shift(self.buy_period))/subset.shift(self.buy_period)) > self.buy_signal)
-                                                 .loc[portfolio.holdings.index[-1], :])]
+            signal = self.window_change(state.prices, state.day, self.buy_period) > self.buy_signal
+        candidates = [coin for coin in coins if signal[state.columns[coin]]]
         
 
         buys = [x for x in candidates if x not in portfolio.hold_duration.keys()]
-        if portfolio.holdings.iloc[-1]['USD'] < 1:
+        if holdings[usd] < 1:
             pass
         else:
-            if portfolio.holdings.iloc[-1]['USD'] < portfolio.valuate()*self.exposure*len(buys):
-                value = math.floor(portfolio.holdings.iloc[-1]['USD'] / len(buys)*100)/100.0 
+            value_before = state.previous_value()
+            if holdings[usd] < value_before*self.exposure*len(buys):
+                value = math.floor(holdings[usd] / len(buys)*100)/100.0 
             else:
-                value = math.floor(portfolio.valuate()*self.exposure*100)/100.0
+                value = math.floor(value_before*self.exposure*100)/100.0
             for coin in buys:           
                 buy_trades.append((coin, value))
 
         return sell_trades, buy_trades
 
+    @staticmethod
+    def streak(prices, day, period, rising=True):
+        '''
+        True for each column of a 2d price array whose price went up (or down, if rising=False)
+        on each of the last `period` rows up to and including row `day`.
+        '''
+        if day - period < 0:
+            return np.zeros(prices.shape[1], dtype=bool)
+        window = prices[day-period:day+1]
+        if rising:
+            return (window[1:] > window[:-1]).all(axis=0)
+        return (window[1:] < window[:-1]).all(axis=0)
+
+    @staticmethod
+    def window_change(prices, day, period):
+        '''
+        Proportional price change of each column of a 2d price array over the `period` rows up to row `day`.
+        NaN where there is not enough history.
+        '''
+        if day - period < 0:
+            return np.full(prices.shape[1], np.nan)
+        return (prices[day] - prices[day-period]) / prices[day-period]
+
 
 def formatted_plotter(portfolios):
     '''
@@ -327,7 +524,7 @@ def formatted_plotter(portfolios):
     return fig
 
 
-@st.cache_data 
+@(st.cache_resource if LEAN_MEMORY else st.cache_data)
 def load_data(path):
     '''
     Creates a Price_data object and triggers the update_data method, which confirms the dataset currently in memory is up to date. 
@@ -337,6 +534,14 @@ def load_data(path):
     data = PriceData(path)
     data.update_data()
     prices = data.load_prices()
+    return clean_prices(prices)
+
+
+def clean_prices(prices):
+    '''
+    Rounds prices to 5 significant figures and renames tokens whose Yahoo Finance ticker doesn't follow the 'XXX-USD' format.
+    Shared by the streamlit app and the headless batch runner, so both simulate against identical price snapshots.
+    '''
     prices = prices.map(lambda x: round(x, 4 - int(math.floor(math.log10(abs(x))))))
     prices = prices.rename(columns={'UNI7083-USD':'UNI-USD', 'STX4847-USD':'STX-USD'})
     return prices
@@ -352,4 +557,38 @@ def load_tokens(path):
         tokens.remove('UNI7083-USD')
         tokens.remove('STX4847-USD')
         tokens.extend(['UNI-USD', 'STX-USD'])
-    return tokens
\ No newline at end of file
+    return tokens
+
+
+@st.cache_resource
+def load_bots(path):
+    '''
+    Loads the prebuilt bots saved in the given folder once per server process.
+    The bots are shared between all sessions, so they are returned as a tuple and must not be modified or simulated further.
+    '''
+    bots = tuple(joblib.load(os.path.join(path, file_name)) for file_name in sorted(os.listdir(path)))
+    for bot in bots:
+        bot.compact(float32=FLOAT32_VALUES)
+    return bots
+
+
+def session_bots(path):
+    '''
+    Returns a new list of bots for a streamlit session, starting with the prebuilt bots in the given folder.
+    In memory-lean mode the prebuilt bots are shared with other sessions, otherwise each session loads its own copies.
+    '''
+    if LEAN_MEMORY:
+        return list(load_bots(path))
+    return [joblib.load(os.path.join(path, file_name)) for file_name in sorted(os.listdir(path))]
+
+
+def session_memory(bots, shared=()):
+    '''
+    Memory accounting for a session's bots, in bytes.
+    Returns a dictionary with the memory held by bots owned by the session, and by bots shared with other sessions.
+    '''
+    shared_ids = {id(bot) for bot in shared}
+    usage = {'session': 0, 'shared': 0}
+    for bot in bots:
+        usage['shared' if id(bot) in shared_ids else 'session'] += bot.memory_usage()
+    return usage
@@ -1,9 +1,7 @@
 
 # Imports
 import pandas as pd
-import joblib
 import json
-import os
 
 import streamlit as st
 from google.cloud import firestore
@@ -11,13 +9,13 @@ from google.oauth2 import service_account
 from datetime import datetime
 
 
-from crypto_bots_classes import Portfolio, StrategyHold, StrategyRules, load_data, load_tokens
+from crypto_bots_classes import Portfolio, StrategyHold, StrategyRules, load_data, load_tokens, session_bots, LEAN_MEMORY, FLOAT32_VALUES
 
 
 # streamlit Configs
 st.set_page_config(page_title="Bot Creator", page_icon="🤖")
 if 'bots' not in st.session_state:
-    st.session_state['bots'] = [joblib.load('bots/'+file_name) for file_name in os.listdir('bots/')]
+    st.session_state['bots'] = session_bots('bots/')
 
 # Firestore log file config
 key_dict = json.loads(st.secrets["textkey"])
@@ -212,6 +210,8 @@ if valid_bot:
                             'roi':bot.roi(),
                             'volatility':round(bot.volatility(), 2)})
                 #joblib.dump(bot, './bots/'+bot_name+'.pkl')
+                if LEAN_MEMORY:
+                    bot.compact(float32=FLOAT32_VALUES)
                 st.session_state['bots'].append(bot)
                 st.write('Bot Saved')
             
@@ -1,16 +1,15 @@
-import os
-import joblib
 import pandas as pd
 
 import streamlit as st
 import plotly.express as px
 
-from crypto_bots_classes import formatted_plotter
+from crypto_bots_classes import formatted_plotter, load_bots, session_bots, session_memory, LEAN_MEMORY
+from portfolio_analytics import portfolio_metrics, rolling_volatility, value_frame
 
 
 st.set_page_config(page_title="Bot Comparisons", page_icon="🔍")
 if 'bots' not in st.session_state:
-    st.session_state['bots'] = [joblib.load('bots/'+file_name) for file_name in os.listdir('bots/')]
+    st.session_state['bots'] = session_bots('bots/')
 
 st.title("Bot Comparison")
 st.write('''Once you have created some trading bots, you can compare their performance here.
@@ -19,29 +18,30 @@ st.write('''Once you have created some trading bots, you can compare their perfo
 bots = st.session_state['bots']
 
 # Generate a summary table of bot metrics
-bot_dict = {'Start Value': [],
-'Current value' : [],
-'Total return': [],
-'Days held': [],
-'Annualised return %':[],
-'Volatility':[]}
-
-for bot in bots:
-    bot_dict['Start Value'].append(bot.start_value)
-    bot_dict['Current value'].append(bot.valuate())
-    bot_dict['Total return'].append(bot.valuate()-bot.start_value)
-    bot_dict['Days held'].append(len(bot.values.index))
-    bot_dict['Annualised return %'].append(round(bot.roi(), 1))
-    bot_dict['Volatility'].append(round(bot.volatility(), 2))
-
-comparison_df = pd.DataFrame.from_dict(bot_dict, orient='columns')
-comparison_df.index=[bot.name for bot in bots]
+metrics = portfolio_metrics(bots)
+comparison_df = pd.DataFrame({'Start Value': metrics['start_value'],
+                              'Current value': metrics['final_value'].round(2),
+                              'Total return': metrics['total_return'].round(2),
+                              'Days held': metrics['days_held'],
+                              'Annualised return %': metrics['roi'].round(1),
+                              'Volatility': metrics['volatility'].round(2),
+                              'Sharpe': metrics['sharpe'].round(2),
+                              'Sortino': metrics['sortino'].round(2),
+                              'Max drawdown %': metrics['max_drawdown'].round(1),
+                              'Drawdown days': metrics['max_drawdown_days'],
+                              'Turnover': metrics['turnover'].round(1)})
 
 st.subheader('Summary Table')
-st.dataframe(comparison_df[['Current value', 'Total return', 'Annualised return %', 'Volatility']].sort_values(by='Annualised return %', ascending=False))
+with st.columns(3)[0]:
+    rank_by = st.selectbox('Rank by', options = ['Annualised return %', 'Sharpe', 'Sortino', 'Max drawdown %', 'Volatility'])
+st.dataframe(comparison_df[['Current value', 'Total return', 'Annualised return %', 'Volatility', 'Sharpe', 'Sortino', 'Max drawdown %', 'Drawdown days', 'Turnover']]
+             .sort_values(by=rank_by, ascending=(rank_by == 'Volatility')))
 
 
-st.write('''**Note**: Volatility is calculated as the standard deviation of daily percentage changes.''')
+st.write('''**Note**: Volatility is calculated as the standard deviation of daily percentage changes. 
+         Sharpe and Sortino ratios are annualised, without a risk-free rate. 
+         Max drawdown is the largest drop from a previous high, and drawdown days the longest time spent below a previous high. 
+         Turnover is the total value traded divided by the average portfolio value.''')
 st.write('''**Warning**: Although annualised returns are likely to be very high, this is not represented of the crypto market. 
          2023-01-01 happened to be a good time to get into the market.
          Future versions of this app will seek to cross-validate strategies with multiple starting points.''')
@@ -55,15 +55,25 @@ m = st.markdown("""
     }
     </style>""", unsafe_allow_html=True)
 if st.button('Delete all created bots'):
-    st.session_state['bots'] = [joblib.load('bots/'+file_name) for file_name in os.listdir('bots/')]
+    st.session_state['bots'] = session_bots('bots/')
     st.experimental_rerun()
 
+# Session memory accounting
+memory = session_memory(bots, load_bots('bots/') if LEAN_MEMORY else ())
+st.caption(f"Bots in this session use {memory['session']/1024:.0f} KB, plus {memory['shared']/1024:.0f} KB shared with other sessions.")
+
 
 
 # portfolio comparison over time
 st.subheader('Performance over time')
 st.plotly_chart(formatted_plotter(bots))
 
+st.subheader('Rolling volatility')
+with st.columns(3)[0]:
+    window = st.selectbox('Window (days)', options = [7, 30, 90], index=1)
+st.plotly_chart(formatted_plotter(rolling_volatility(value_frame(bots), window)))
+st.write('Standard deviation of daily percentage changes over the previous days of the window, as for Volatility in the summary table.')
+
 
 
 
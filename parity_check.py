@@ -0,0 +1,248 @@
+'''
+Parity checks between the simulation engines.
+
+Portfolio.new_simulate_update reads prices and holdings by integer position for speed. This script checks that it still
+gives exactly the same value histories, holdings and trade logs as the original label-based simulation, which is kept
+here as ReferencePortfolio and ReferenceRules. It also checks that the batched simulation core in batch_simulation.py
+matches Portfolio, both without trading costs and with an all-zero CostModel.
+Run it after changing any of the simulation code:
+
+    python parity_check.py --prices data/prices.csv
+    python parity_check.py --skip-reference        (only the fast check of the batched core against Portfolio)
+
+It exits with an error listing every configuration whose results differ.
+'''
+import argparse
+import itertools
+import math
+import sys
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from crypto_bots_classes import Portfolio, PriceIndex, StrategyHold, StrategyRules
+from batch_runner import load_snapshot
+from batch_simulation import CostModel, simulate_batch
+
+
+START_DATE = '2023-01-01'
+START_VALUE = 1000
+# the batched core sums values in a different order than pandas, so its daily values may differ by rounding
+BATCH_TOLERANCE = 1e-6
+
+
+class ReferencePortfolio(Portfolio):
+    '''
+    Portfolio with the original label-based simulation, stepping through calendar days with pandas lookups.
+    Slow, but straightforward to check by reading. Assumes prices has a row for every calendar day.
+    '''
+    def valuate(self):
+        return round(self.values.sum(axis=1).iloc[-1], 2)
+
+    def execute_sell(self, coin, date, prices):
+        value = math.floor(self.holdings.loc[date, coin]*prices.loc[date, coin]*100)/100.0
+        self.holdings.loc[date, 'USD'] += value
+        self.holdings.loc[date, coin] = 0
+        self.hold_duration.pop(coin)
+        if coin[:-4] in self.live_positions.keys():
+            self.trades_log.loc[self.live_positions[coin[:-4]]['index'], ['sell_date', 'sell_value', 'profit']] = (date.date(), value, value-self.trades_log.loc[self.live_positions[coin[:-4]]['index'], 'buy_value'])
+        return
+
+    def execute_buy(self, coin, value, date, prices):
+        if value > self.holdings.loc[date, 'USD']:
+            self.error_log['not enough cash'] += 1
+            return
+        else:
+            self.holdings.loc[date, 'USD'] = self.holdings.loc[date, 'USD'] - value
+            self.holdings.loc[date, coin] = self.holdings.loc[date, coin] + (value/prices.loc[date, coin])
+            self.hold_duration[coin] = 0
+            self.trades_log = pd.concat([self.trades_log, pd.DataFrame({'buy_date':[date.date()], 'coin':[coin[:-4]], 'amount':[value/prices.loc[date, coin]], 'buy_value':[value], 'sell_date':[pd.NaT], 'sell_value':[np.nan], 'profit':[np.nan]}, index = [self.trade_id])])
+            self.live_positions[coin[:-4]] = {'index':self.trade_id, 'amount':[value/prices.loc[date, coin]]}
+            self.trade_id += 1
+            return
+
+    def new_simulate_update(self, prices, verbose=True):
+        for date in pd.date_range(start=self.holdings.index[-1]+pd.DateOffset(days=1), end=prices.index[-1]):
+            self.holdings.loc[date, :] = self.holdings.loc[date-pd.DateOffset(days=1), :]
+            self.hold_duration = {k: v+1 for k,v in self.hold_duration.items()}
+            sell_trades, buy_trades = self.strategy.think(self, date, prices)
+            for trade in sell_trades:
+                self.execute_sell(trade, date, prices)
+            for trade in buy_trades:
+                self.execute_buy(*trade, date, prices)
+            self.values.loc[date, :] = prices.loc[date, self.holdings.columns] * self.holdings.loc[date, :]
+        if verbose:
+            print(self.error_log)
+
+
+class ReferenceRules(StrategyRules):
+    '''
+    StrategyRules with the original think, which reads the live holdings and values DataFrames of a ReferencePortfolio.
+    '''
+    def think(self, portfolio, date, prices):
+        if self.sell_rule == 'hold':
+            sell_trades = [coin for coin in portfolio.hold_duration if portfolio.hold_duration[coin] >= self.sell_period]
+        elif self.sell_rule == 'reversal':
+            candidates = [coin for coin in portfolio.holdings.iloc[-1].index if portfolio.holdings.iloc[-1].loc[coin] > 0 and coin != 'USD']
+            subset = prices.loc[:, candidates]
+            requirements = []
+            for i in range(self.sell_period):
+                requirements.append(subset.shift(i)<subset.shift(i+1))
+                candidates = subset.columns[np.where((sum(requirements) == self.sell_period)
+                                                 .loc[portfolio.holdings.index[-1], :])]
+            sell_trades = candidates
+
+        buy_trades = []
+        subset = prices.loc[:, portfolio.holdings.columns.drop('USD')]
+        if self.buy_rule == 'consecutive':
+            requirements = []
+            for i in range(self.buy_period):
+                requirements.append(subset.shift(i)>subset.shift(i+1))
+            candidates = subset.columns[np.where((sum(requirements) == self.buy_period)
+                                                 .loc[portfolio.holdings.index[-1], :])]
+        elif self.buy_rule == 'window':
+            candidates = subset.columns[np.where((((subset - subset.shift(self.buy_period))/subset.shift(self.buy_period)) > self.buy_signal)
+                                                 .loc[portfolio.holdings.index[-1], :])]
+
+        buys = [x for x in candidates if x not in portfolio.hold_duration.keys()]
+        if portfolio.holdings.iloc[-1]['USD'] < 1:
+            pass
+        else:
+            if portfolio.holdings.iloc[-1]['USD'] < portfolio.valuate()*self.exposure*len(buys):
+                value = math.floor(portfolio.holdings.iloc[-1]['USD'] / len(buys)*100)/100.0
+            else:
+                value = math.floor(portfolio.valuate()*self.exposure*100)/100.0
+            for coin in buys:
+                buy_trades.append((coin, value))
+
+        return sell_trades, buy_trades
+
+
+def configurations(tokens):
+    '''
+    Strategy parameters and allocations covering every buy and sell rule, short and long periods,
+    exposures both small enough to buy freely and large enough to run out of cash, and allocations in and out of
+    the column order of the prices.
+    Returns a list of (strategy parameters, allocation) pairs; parameters are None for a HOLD strategy.
+    '''
+    configs = []
+    for buy_rule, buy_period, sell_rule, sell_period, exposure in itertools.product(
+            ['consecutive', 'window'], [1, 2, 4], ['hold', 'reversal'], [1, 3], [0.1, 10]):
+        buy_signal = 0.02 if buy_rule == 'window' else 0
+        configs.append(((buy_rule, buy_period, buy_signal, sell_rule, sell_period, exposure),
+                        dict({token: 0 for token in tokens[:8]}, USD=1)))
+    # allocations listing tokens out of column order, as from load_tokens or a sweep grid: trades must follow this order
+    permuted = [tokens[i] for i in (5, 7, 2, 0, 6, 1, 4, 3)]
+    for buy_rule, sell_rule, exposure in itertools.product(['consecutive', 'window'], ['hold', 'reversal'], [0.3, 10]):
+        buy_signal = 0.02 if buy_rule == 'window' else 0
+        configs.append(((buy_rule, 1, buy_signal, sell_rule, 3, exposure), dict({token: 0 for token in permuted}, USD=1)))
+    configs.append((None, {tokens[0]: 0.5, tokens[1]: 0.5}))
+    return configs
+
+
+def build_strategy(params, reference=False):
+    if params is None:
+        return StrategyHold()
+    return (ReferenceRules if reference else StrategyRules)(*params)
+
+
+def comparable(table):
+    '''
+    Copy of a holdings, values or trades_log table with the dtypes both engines agree on: float numbers, datetime dates.
+    '''
+    table = table.copy()
+    for col in table.columns:
+        if col.endswith('_date'):
+            table[col] = pd.to_datetime(table[col])
+        elif col != 'coin':
+            table[col] = table[col].astype(float)
+    return table
+
+
+def check_portfolio(prices, configs):
+    '''
+    Simulates every configuration with Portfolio and ReferencePortfolio, and returns a list of the differences found.
+    Value histories, holdings and trade logs must match exactly.
+    '''
+    differences = []
+    for params, allocation in configs:
+        bot = Portfolio('bot', allocation, START_DATE, START_VALUE, prices, build_strategy(params))
+        bot.new_simulate_update(prices, verbose=False)
+        reference = ReferencePortfolio('reference', allocation, START_DATE, START_VALUE, prices, build_strategy(params, reference=True))
+        reference.new_simulate_update(prices, verbose=False)
+
+        for table in ['holdings', 'values', 'trades_log']:
+            try:
+                pd.testing.assert_frame_equal(comparable(getattr(bot, table)), comparable(getattr(reference, table)),
+                                              check_exact=True, check_freq=False)
+            except AssertionError as e:
+                differences.append(f'Portfolio {params}: {table} differs from the reference: {e}')
+        if bot.error_log != reference.error_log:
+            differences.append(f'Portfolio {params}: error log {bot.error_log} != {reference.error_log}')
+    return differences
+
+
+def check_batch(prices, configs):
+    '''
+    Simulates all configurations in one batch with simulate_batch, without costs and with an all-zero CostModel,
+    and compares each bot's daily values, final holdings and trade counts with a Portfolio simulation.
+    Returns a list of the differences found.
+    '''
+    index = PriceIndex.of(prices)
+    tokens = [token for token in index.tokens if token != 'USD']
+    strategies = [build_strategy(params) for params, allocation in configs]
+    allocations = [allocation for params, allocation in configs]
+    batch_prices = index.array[None][:, :, index.token_locs(tokens)]
+    start = index.date_loc(START_DATE)
+
+    differences = []
+    for label, costs in [('no costs', None), ('zero costs', CostModel())]:
+        simulation = simulate_batch(batch_prices, start, strategies, allocations, tokens, START_VALUE,
+                                    gaps=index.day_gaps(), costs=costs)
+        for bot_number, (params, allocation) in enumerate(configs):
+            bot = Portfolio('bot', allocation, START_DATE, START_VALUE, prices, strategies[bot_number])
+            bot.new_simulate_update(prices, verbose=False)
+
+            value_error = np.abs(simulation['values'][0, bot_number] - bot.values.sum(axis=1).to_numpy()).max()
+            if value_error > BATCH_TOLERANCE:
+                differences.append(f'Batch {params}, {label}: daily values differ by up to {value_error}')
+            holdings = bot.holdings.iloc[-1].reindex(tokens, fill_value=0).to_numpy(dtype=float)
+            if not np.allclose(simulation['holdings'][0, bot_number], holdings, rtol=BATCH_TOLERANCE, atol=0):
+                differences.append(f'Batch {params}, {label}: final holdings differ')
+            if simulation['costs'][0, bot_number] != 0:
+                differences.append(f"Batch {params}, {label}: paid {simulation['costs'][0, bot_number]} in costs")
+
+            counts = {'buys': bot.trades_log.shape[0],
+                      'sells': int(bot.trades_log['sell_value'].notna().sum()) if bot.trades_log.shape[0] else 0,
+                      'not_enough_cash': bot.error_log['not enough cash']}
+            for count, expected in counts.items():
+                if simulation[count][0, bot_number] != expected:
+                    differences.append(f'Batch {params}, {label}: {simulation[count][0, bot_number]} {count} instead of {expected}')
+    return differences
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check that the simulation engines give the same results.')
+    parser.add_argument('--prices', default='data/prices.csv', help='price snapshot csv (default: data/prices.csv)')
+    parser.add_argument('--skip-reference', action='store_true', help='skip the slow check against the original simulation')
+    args = parser.parse_args(argv)
+
+    # the reference reproduces the original pandas usage, which newer pandas versions warn about
+    warnings.simplefilter('ignore', FutureWarning)
+    prices = load_snapshot(args.prices)
+    tokens = [token for token in prices.columns if token != 'USD']
+    configs = configurations(tokens)
+
+    differences = check_batch(prices, configs)
+    if not args.skip_reference:
+        differences += check_portfolio(prices, configs)
+    for difference in differences:
+        print(difference)
+    if differences:
+        sys.exit(f'{len(differences)} differences found')
+    print(f'All {len(configs)} configurations match')
+
+
+if __name__ == '__main__':
+    main()
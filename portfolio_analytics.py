@@ -0,0 +1,213 @@
+'''
+Risk and performance analytics for portfolio value histories.
+
+compute_metrics() calculates the full metric set for any number of portfolios in one vectorized pass over a
+DataFrame of value histories (one column per portfolio), instead of rescanning each history per metric.
+StreamingMetrics keeps the same metrics up to date as new days are appended, without revisiting earlier days.
+'''
+import warnings
+
+import numpy as np
+import pandas as pd
+
+
+METRICS = ['start_value', 'final_value', 'total_return', 'days_held', 'roi', 'volatility', 'sharpe', 'sortino',
+           'max_drawdown', 'max_drawdown_days', 'turnover', 'exposure']
+
+
+def value_frame(portfolios):
+    '''
+    Combines the value histories of a list of Portfolio objects into one DataFrame, one column per portfolio name.
+    Portfolios that started later are NaN before their first day.
+    '''
+    return pd.concat([portfolio.value_history().rename(portfolio.name) for portfolio in portfolios], axis=1)
+
+
+def traded_value(portfolio):
+    '''
+    Total value bought and sold by a portfolio, from its trade log.
+    '''
+    if portfolio.trades_log.shape[0] == 0:
+        return 0.0
+    return float(portfolio.trades_log['buy_value'].sum() + portfolio.trades_log['sell_value'].sum())
+
+
+def exposure(portfolio):
+    '''
+    Share of a portfolio's value held in tokens rather than USD, for each day.
+    '''
+    total = portfolio.values.sum(axis=1).astype(float)
+    return 1 - portfolio.values['USD'].astype(float) / total
+
+
+def rolling_volatility(values, window=30):
+    '''
+    Rolling volatility of each value history, as the standard deviation of daily percentage changes over `window` days.
+    '''
+    return values.pct_change(fill_method=None).rolling(window, min_periods=2).std() * 100
+
+
+def portfolio_metrics(portfolios, periods_per_year=365):
+    '''
+    Full metric set for a list of Portfolio objects, indexed by portfolio name. See compute_metrics.
+    '''
+    names = [portfolio.name for portfolio in portfolios]
+    return compute_metrics(value_frame(portfolios),
+                           start_values=pd.Series([portfolio.start_value for portfolio in portfolios], index=names),
+                           traded=pd.Series([traded_value(portfolio) for portfolio in portfolios], index=names),
+                           exposures=pd.concat([exposure(portfolio).rename(portfolio.name) for portfolio in portfolios], axis=1),
+                           periods_per_year=periods_per_year)
+
+
+def compute_metrics(values, start_values=None, traded=None, exposures=None, periods_per_year=365):
+    '''
+    Computes risk and performance metrics for every column of a DataFrame of daily portfolio values in one pass.
+
+    inputs
+    values: DataFrame of portfolio values, one column per portfolio, NaN before a portfolio's first day
+    start_values: optional Series of start values per column, defaults to each column's first value
+    traded: optional Series of total traded value per column (see traded_value), needed for turnover
+    exposures: optional DataFrame of daily exposure per column (see exposure), needed for average exposure
+    periods_per_year: number of rows per year, used to annualise roi, sharpe and sortino
+
+    returns
+    a DataFrame indexed by column name with:
+    roi: annualised return in %, as Portfolio.roi
+    volatility: standard deviation of daily percentage changes, as Portfolio.volatility
+    sharpe, sortino: annualised mean daily return over its standard deviation, or over its downside deviation
+    max_drawdown: largest fall from a previous peak in %, as a negative number
+    max_drawdown_days: longest time in calendar days (rows, if values has no DatetimeIndex) spent below a previous peak
+    turnover: total traded value divided by the average portfolio value
+    exposure: average share of value held in tokens rather than USD
+    '''
+    v = values.to_numpy(dtype=float)
+    if v.shape[0] == 0:
+        return pd.DataFrame(np.nan, index=values.columns, columns=METRICS)
+    rows = np.arange(v.shape[0])[:, None]
+    valid = ~np.isnan(v)
+    days_held = valid.sum(axis=0)
+    first = v[np.argmax(valid, axis=0), np.arange(v.shape[1])]
+    final = v[v.shape[0] - 1 - np.argmax(valid[::-1], axis=0), np.arange(v.shape[1])]
+    start = first if start_values is None else start_values.reindex(values.columns).to_numpy(dtype=float)
+
+    if isinstance(values.index, pd.DatetimeIndex):
+        day_numbers = (values.index.values.astype('datetime64[D]').astype(np.int64) - values.index.values[:1].astype('datetime64[D]').astype(np.int64))[:, None]
+    else:
+        day_numbers = rows
+
+    with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+
+        returns = v[1:] / v[:-1] - 1
+        mean = np.nanmean(returns, axis=0)
+        std = np.nanstd(returns, axis=0, ddof=1)
+        downside = np.sqrt(np.nanmean(np.minimum(returns, 0)**2, axis=0))
+
+        peak = np.fmax.accumulate(v, axis=0)
+        drawdown = v / peak - 1
+        underwater = drawdown < 0
+        last_peak = np.maximum.accumulate(np.where(underwater, 0, day_numbers), axis=0)
+        underwater_days = np.where(underwater, day_numbers - last_peak, 0)
+
+        metrics = pd.DataFrame({'start_value': start,
+                                'final_value': final,
+                                'total_return': final - start,
+                                'days_held': days_held,
+                                'roi': ((final / start)**(periods_per_year / days_held) - 1) * 100,
+                                'volatility': std * 100,
+                                'sharpe': mean / std * np.sqrt(periods_per_year),
+                                'sortino': mean / downside * np.sqrt(periods_per_year),
+                                'max_drawdown': np.nanmin(drawdown, axis=0) * 100,
+                                'max_drawdown_days': underwater_days.max(axis=0),
+                                'turnover': np.nan if traded is None else traded.reindex(values.columns).to_numpy(dtype=float) / np.nanmean(v, axis=0),
+                                'exposure': np.nan if exposures is None else exposures.reindex(columns=values.columns).mean(axis=0).to_numpy()},
+                               index=values.columns, columns=METRICS)
+    return metrics
+
+
+class StreamingMetrics():
+    '''
+    Incrementally maintained version of compute_metrics, for value histories that grow a few days at a time.
+    Initialise with the portfolio names, then call update() with each batch of new daily values.
+    Only running totals are kept, so each update costs the same no matter how long the history already is.
+    Turnover and exposure are not tracked, as they need the trade log and holdings rather than values.
+    '''
+    def __init__(self, columns, start_values=None, periods_per_year=365):
+        self.columns = pd.Index(columns)
+        self.periods_per_year = periods_per_year
+        n = len(self.columns)
+        self.start_values = None if start_values is None else pd.Series(start_values).reindex(self.columns).to_numpy(dtype=float)
+        self.first = np.full(n, np.nan)
+        self.last = np.full(n, np.nan)
+        self.days_held = np.zeros(n, dtype=int)
+        # running mean and sum of squared deviations of daily returns (Welford's algorithm)
+        self.n_returns = np.zeros(n, dtype=int)
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)
+        self.downside_sq = np.zeros(n)
+        self.peak = np.full(n, np.nan)
+        self.peak_day = np.zeros(n)
+        self.max_drawdown = np.zeros(n)
+        self.max_drawdown_days = np.zeros(n)
+        self.rows_seen = 0
+        self.first_day = None
+
+    def update(self, values):
+        '''
+        Adds new daily values, given as a DataFrame with (a subset of) the tracked columns and one row per new day.
+        '''
+        v = values.reindex(columns=self.columns).to_numpy(dtype=float)
+        if isinstance(values.index, pd.DatetimeIndex):
+            if self.first_day is None and len(values.index):
+                self.first_day = values.index[0]
+            day_numbers = ((values.index - self.first_day) / pd.Timedelta(days=1)).to_numpy(dtype=float)
+        else:
+            day_numbers = np.arange(self.rows_seen, self.rows_seen + v.shape[0], dtype=float)
+        self.rows_seen += v.shape[0]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for row, day in zip(v, day_numbers):
+                valid = ~np.isnan(row)
+                new = valid & (self.days_held == 0)
+                self.first[new] = row[new]
+                self.peak[new] = row[new]
+                self.peak_day[new] = day
+
+                has_return = valid & (self.days_held > 0)
+                ret = row / self.last - 1
+                self.n_returns += has_return
+                delta = np.where(has_return, ret - self.mean, 0)
+                self.mean += np.where(has_return, delta / np.maximum(self.n_returns, 1), 0)
+                self.m2 += np.where(has_return, delta * (ret - self.mean), 0)
+                self.downside_sq += np.where(has_return, np.minimum(ret, 0)**2, 0)
+
+                at_peak = valid & (row >= self.peak)
+                self.peak = np.where(at_peak, row, self.peak)
+                self.peak_day = np.where(at_peak, day, self.peak_day)
+                self.max_drawdown = np.where(valid, np.minimum(self.max_drawdown, row / self.peak - 1), self.max_drawdown)
+                self.max_drawdown_days = np.where(valid, np.maximum(self.max_drawdown_days, day - self.peak_day), self.max_drawdown_days)
+
+                self.last = np.where(valid, row, self.last)
+                self.days_held += valid
+
+    def metrics(self):
+        '''
+        Current metrics for all tracked columns, in the same format as compute_metrics.
+        '''
+        start = self.first if self.start_values is None else self.start_values
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.sqrt(self.m2 / (self.n_returns - 1))
+            downside = np.sqrt(self.downside_sq / self.n_returns)
+            return pd.DataFrame({'start_value': start,
+                                 'final_value': self.last,
+                                 'total_return': self.last - start,
+                                 'days_held': self.days_held,
+                                 'roi': ((self.last / start)**(self.periods_per_year / self.days_held) - 1) * 100,
+                                 'volatility': std * 100,
+                                 'sharpe': self.mean / std * np.sqrt(self.periods_per_year),
+                                 'sortino': self.mean / downside * np.sqrt(self.periods_per_year),
+                                 'max_drawdown': self.max_drawdown * 100,
+                                 'max_drawdown_days': self.max_drawdown_days.astype(int),
+                                 'turnover': np.nan,
+                                 'exposure': np.nan},
+                                index=self.columns, columns=METRICS)
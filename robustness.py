@@ -0,0 +1,96 @@
+'''
+Monte Carlo robustness testing of strategies.
+
+A single historical price path can make a strategy look better than it is. This module generates synthetic
+price paths from the stored history with a block bootstrap of joint daily returns, which keeps the correlations
+between tokens and short-term momentum within each block, and runs strategies across all paths at once with
+the batched simulation core. Paths are generated and simulated in chunks, so memory use is bounded by the
+chunk size rather than the number of paths.
+'''
+import numpy as np
+import pandas as pd
+
+from crypto_bots_classes import PriceIndex
+from batch_simulation import simulate_batch
+from portfolio_analytics import compute_metrics
+
+
+def bootstrap_paths(history, start, n_paths, block_size=10, rng=None):
+    '''
+    Generates synthetic price paths from a history of prices (days, tokens).
+    Rows up to and including `start` are kept as they are, so strategies have the real history to look back on.
+    Every later day is built from blocks of `block_size` consecutive daily returns of all tokens together,
+    drawn with replacement from the whole history.
+
+    returns
+    an array of prices (n_paths, days, tokens)
+    '''
+    rng = np.random.default_rng(rng)
+    returns = history[1:] / history[:-1]
+    n_future = history.shape[0] - start - 1
+    block_size = max(1, min(block_size, returns.shape[0]))
+
+    n_blocks = -(-n_future // block_size)
+    block_starts = rng.integers(0, returns.shape[0] - block_size + 1, size=(n_paths, n_blocks))
+    rows = (block_starts[:, :, None] + np.arange(block_size)).reshape(n_paths, -1)[:, :n_future]
+
+    paths = np.empty((n_paths,) + history.shape)
+    paths[:, :start + 1] = history[:start + 1]
+    paths[:, start + 1:] = history[start] * np.cumprod(returns[rows], axis=1)
+    return paths
+
+
+def robustness_test(strategies, allocations, prices, start_date, start_values=1000, names=None,
+                    n_paths=1000, block_size=10, chunk_size=200, seed=None, costs=None):
+    '''
+    Simulates each strategy on n_paths bootstrapped price paths.
+
+    inputs
+    strategies, allocations: one StrategyHold or StrategyRules object and one initial_split dictionary per bot, as for Portfolio
+    prices: price DataFrame, as returned by load_data
+    start_date: start date of every bot; the synthetic paths start from the real prices on this date
+    start_values: start value per bot, or one for all bots
+    names: optional bot names, defaults to 0, 1, 2...
+    n_paths, block_size: number of synthetic paths, and number of consecutive days of returns drawn together
+    chunk_size: number of paths generated and simulated at once
+    seed: random seed, for reproducible paths
+    costs: optional batch_simulation.CostModel applied to every trade
+
+    returns
+    a DataFrame with one row per path and bot, with the roi, volatility and max_drawdown of the bot on that path,
+    as defined in portfolio_analytics.compute_metrics
+    '''
+    index = PriceIndex.of(prices)
+    tokens = [token for token in index.tokens if token != 'USD']
+    history = index.array[:, index.token_locs(tokens)]
+    start = index.date_loc(start_date)
+    names = list(range(len(strategies))) if names is None else list(names)
+    start_values = np.broadcast_to(np.asarray(start_values, dtype=float), (len(strategies),))
+    rng = np.random.default_rng(seed)
+
+    results = []
+    for first_path in range(0, n_paths, chunk_size):
+        n_chunk = min(chunk_size, n_paths - first_path)
+        paths = bootstrap_paths(history, start, n_chunk, block_size, rng)
+        simulation = simulate_batch(paths, start, strategies, allocations, tokens, start_values, gaps=index.day_gaps(), costs=costs)
+
+        # one column per (path, bot), rounded to cents like Portfolio.value_history
+        values = np.round(simulation['values'], 2).reshape(n_chunk * len(strategies), -1).T
+        metrics = compute_metrics(pd.DataFrame(values), start_values=pd.Series(np.tile(start_values, n_chunk)))
+        results.append(pd.DataFrame({'path': np.repeat(np.arange(first_path, first_path + n_chunk), len(strategies)),
+                                     'bot': np.tile(names, n_chunk),
+                                     'roi': metrics['roi'].to_numpy(),
+                                     'volatility': metrics['volatility'].to_numpy(),
+                                     'max_drawdown': metrics['max_drawdown'].to_numpy()}))
+    return pd.concat(results, ignore_index=True)
+
+
+def robustness_summary(results, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+    '''
+    Distribution of roi, volatility and max_drawdown per bot over all paths of a robustness_test,
+    with the share of paths on which the bot lost money.
+    '''
+    summary = results.groupby('bot')[['roi', 'volatility', 'max_drawdown']].quantile(list(quantiles)).unstack()
+    summary.columns = [f'{metric}_q{int(round(q*100))}' for metric, q in summary.columns]
+    summary['loss_share'] = results.assign(loss=results['roi'] < 0).groupby('bot')['loss'].mean()
+    return summary
@@ -0,0 +1,406 @@
+'''
+Sharded strategy sweeps over a file-based work queue.
+
+A coordinator expands a grid of StrategyRules parameters and token sets into configurations, and shards them
+into work units in a queue directory on a filesystem shared by all machines. Any number of workers, on any number
+of hosts, claim units, simulate them with the batched simulation core against the price snapshot pinned in the
+queue, and write one result shard per unit. A reducer merges the shards into a single leaderboard.
+No broker is needed: a unit is claimed by exclusively creating its claim file, which only one worker can do,
+and is done once its result shard exists. A worker refreshes its claim while running a unit; claims that haven't
+been refreshed for --stale-after seconds are assumed to belong to a dead worker and are taken over by the next worker
+that finds them. A unit whose simulation raises an error gets an error file instead of a result shard, with the
+traceback, and is not retried; status and reduce report it. Delete the error file to queue the unit again.
+
+Usage:
+    python sweep_queue.py init sweep/ --grid grid.json --prices data/prices.csv --unit-size 100
+    python sweep_queue.py work sweep/          (start as many as you like, on any host that sees sweep/)
+    python sweep_queue.py status sweep/
+    python sweep_queue.py reduce sweep/ --rank sharpe
+
+A grid file lists the values to sweep for every StrategyRules parameter, and the token sets to trade:
+    {"buy_rule": ["consecutive", "window"], "buy_period": [1, 2, 3], "buy_signal": [0, 0.05],
+     "sell_rule": ["hold", "reversal"], "sell_period": [1, 2, 5], "exposure": [0.1, 0.2],
+     "tokens": [["BTC-USD", "ETH-USD"], ["BTC-USD", "ETH-USD", "SOL-USD"]],
+     "fee_rate": [0, 0.001], "spread": [0, 0.002],
+     "start_date": "2023-01-01", "start_value": 1000}
+tokens can also be {"pool": [...], "size": k} to sweep every k-token subset of the pool. Without it, every bot
+considers all tokens in data/token_list.txt. buy_signal is only swept for window rules.
+Trading costs are swept like the strategy parameters, with the optional fixed_fee, fee_rate, spread and slippage
+lists and a single liquidity value, as defined by batch_simulation.CostModel. They default to no costs.
+'''
+import argparse
+import glob
+import hashlib
+import itertools
+import json
+import contextlib
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from crypto_bots_classes import PriceIndex, StrategyRules, load_tokens
+from batch_runner import load_snapshot
+from batch_simulation import BUY_RULES, SELL_RULES, CostModel, simulate_batch
+from portfolio_analytics import compute_metrics
+
+
+RANK_ASCENDING = {'volatility': True, 'max_drawdown_days': True}
+COST_PARAMETERS = ['fixed_fee', 'fee_rate', 'spread', 'slippage']
+
+
+def expand_grid(grid, default_tokens):
+    '''
+    Expands a sweep grid into a list of configuration dictionaries, each with a unique integer id.
+    '''
+    tokens = grid.get('tokens', [default_tokens])
+    if isinstance(tokens, dict):
+        tokens = [list(subset) for subset in itertools.combinations(tokens['pool'], tokens['size'])]
+
+    costs = [dict(zip(COST_PARAMETERS, values))
+             for values in itertools.product(*[grid.get(parameter, [0]) for parameter in COST_PARAMETERS])]
+
+    configs = []
+    for buy_rule, buy_period, sell_rule, sell_period, exposure, token_set, cost in itertools.product(
+            grid['buy_rule'], grid['buy_period'], grid['sell_rule'], grid['sell_period'], grid['exposure'], tokens, costs):
+        signals = grid.get('buy_signal', [0]) if buy_rule == 'window' else [0]
+        for buy_signal in signals:
+            configs.append(dict({'id': len(configs), 'buy_rule': buy_rule, 'buy_period': buy_period, 'buy_signal': buy_signal,
+                                 'sell_rule': sell_rule, 'sell_period': sell_period, 'exposure': exposure, 'tokens': token_set},
+                                **cost))
+    return configs
+
+
+def check_configs(configs, prices, start_date):
+    '''
+    Raises a ValueError if any configuration uses a rule the batched simulation core doesn't support,
+    or a token that isn't in the price snapshot, or if the start date isn't in the price snapshot.
+    '''
+    try:
+        PriceIndex.of(prices).date_loc(start_date)
+    except KeyError as e:
+        raise ValueError(f'Start date of the grid not found in the price snapshot: {e.args[0]}') from None
+    for rule, supported in [('buy_rule', BUY_RULES), ('sell_rule', SELL_RULES)]:
+        unknown = sorted({c[rule] for c in configs} - set(supported))
+        if unknown:
+            raise ValueError(f'Unknown {rule} in grid: {unknown}, expected one of {list(supported)}')
+    unknown = sorted({token for c in configs for token in c['tokens']} - set(prices.columns.drop('USD', errors='ignore')))
+    if unknown:
+        raise ValueError(f'Tokens in grid not found in the price snapshot: {unknown}')
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def write_atomic(path, write):
+    '''
+    Writes a file through a temporary file in the same directory, so other processes never see it half written.
+    '''
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def init_queue(queue_dir, grid, prices, default_tokens, unit_size=100):
+    '''
+    Creates a queue directory: the pinned price snapshot, a manifest, and the configurations sharded into work units.
+    '''
+    if os.path.exists(os.path.join(queue_dir, 'manifest.json')):
+        raise FileExistsError(f'{queue_dir} already contains a sweep')
+    configs = expand_grid(grid, default_tokens)
+    start_date = grid.get('start_date', '2023-01-01')
+    check_configs(configs, prices, start_date)
+
+    for folder in ['units', 'claims', 'results']:
+        os.makedirs(os.path.join(queue_dir, folder), exist_ok=True)
+
+    prices_path = os.path.join(queue_dir, 'prices.parquet')
+    prices.to_parquet(prices_path)
+
+    units = [configs[i:i + unit_size] for i in range(0, len(configs), unit_size)]
+    for number, unit in enumerate(units):
+        with open(os.path.join(queue_dir, 'units', f'unit-{number:06d}.json'), 'w') as f:
+            json.dump(unit, f)
+
+    manifest = {'prices_sha256': file_hash(prices_path),
+                'start_date': start_date,
+                'start_value': grid.get('start_value', 1000),
+                'liquidity': grid.get('liquidity', 1e6),
+                'configs': len(configs),
+                'units': len(units)}
+    with open(os.path.join(queue_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_queue(queue_dir):
+    '''
+    Reads the manifest and the pinned price snapshot of a queue, checking the snapshot hasn't changed since init.
+    '''
+    with open(os.path.join(queue_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    prices_path = os.path.join(queue_dir, 'prices.parquet')
+    if file_hash(prices_path) != manifest['prices_sha256']:
+        raise ValueError(f'{prices_path} does not match the snapshot pinned in the manifest')
+    return manifest, pd.read_parquet(prices_path)
+
+
+def unit_names(queue_dir):
+    return sorted(os.path.basename(path)[:-len('.json')] for path in glob.glob(os.path.join(queue_dir, 'units', 'unit-*.json')))
+
+
+def is_done(queue_dir, unit):
+    return os.path.exists(os.path.join(queue_dir, 'results', f'{unit}.parquet'))
+
+
+def has_failed(queue_dir, unit):
+    return os.path.exists(os.path.join(queue_dir, 'results', f'{unit}.error'))
+
+
+def claim_unit(queue_dir, unit, worker, stale_after):
+    '''
+    Tries to claim a unit for this worker. Returns True if the claim succeeded.
+    A stale claim is first moved out of the way. If another worker took it over and created a fresh claim in the
+    meantime, the moved claim isn't stale anymore and is put back. Two workers can still both run a unit if a third
+    one claims it while a fresh claim is being put back, which is harmless as they write the same result.
+    '''
+    claim_path = os.path.join(queue_dir, 'claims', f'{unit}.claim')
+    try:
+        if time.time() - os.path.getmtime(claim_path) < stale_after:
+            return False
+        stale_path = f'{claim_path}.stale-{uuid.uuid4().hex}'
+        os.rename(claim_path, stale_path)
+        if time.time() - os.path.getmtime(stale_path) < stale_after:
+            # moved another worker's fresh claim: put it back, unless yet another claim exists by now
+            try:
+                os.link(stale_path, claim_path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+    except FileNotFoundError:
+        pass
+
+    try:
+        fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'worker': worker, 'claimed_at': time.time()}, f)
+    return True
+
+
+@contextlib.contextmanager
+def keep_claimed(claim_path, interval):
+    '''
+    Refreshes the modification time of a claim file every `interval` seconds while the block runs,
+    so other workers don't take over a claim on a unit that is still being worked on.
+    '''
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(interval):
+            try:
+                os.utime(claim_path)
+            except FileNotFoundError:
+                # the claim was taken over after all; the other worker writes the same result
+                pass
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_unit(configs, prices, start_date, start_value, liquidity=1e6):
+    '''
+    Simulates all configurations of a work unit in one batch, and returns their metrics as a DataFrame.
+    '''
+    index = PriceIndex.of(prices)
+    tokens = [token for token in index.tokens if token != 'USD']
+    strategies = [StrategyRules(c['buy_rule'], c['buy_period'], c['buy_signal'], c['sell_rule'], c['sell_period'], c['exposure'])
+                  for c in configs]
+    allocations = [dict({token: 0 for token in c['tokens']}, USD=1) for c in configs]
+    costs = CostModel(liquidity=liquidity, **{parameter: [c.get(parameter, 0) for c in configs] for parameter in COST_PARAMETERS})
+
+    simulation = simulate_batch(index.array[None][:, :, index.token_locs(tokens)], index.date_loc(start_date),
+                                strategies, allocations, tokens, start_value, gaps=index.day_gaps(), costs=costs)
+    values = pd.DataFrame(np.round(simulation['values'][0].T, 2), index=index.dates[index.date_loc(start_date):])
+    metrics = compute_metrics(values, start_values=pd.Series(float(start_value), index=values.columns),
+                              traded=pd.Series(simulation['traded_value'][0], index=values.columns))
+
+    results = pd.DataFrame(configs)
+    results['tokens'] = results['tokens'].map(' '.join)
+    results = pd.concat([results, metrics.drop(columns=['start_value', 'exposure']).reset_index(drop=True)], axis=1)
+    results['buys'] = simulation['buys'][0]
+    results['costs'] = simulation['costs'][0]
+    results['not_enough_cash'] = simulation['not_enough_cash'][0]
+    return results
+
+
+def work(queue_dir, stale_after=600, poll_interval=5, worker=None):
+    '''
+    Claims and runs work units until every unit in the queue has a result or an error.
+    While the remaining units are all claimed by other workers, waits for them, taking over claims that go stale.
+    Returns the number of units this worker completed.
+    '''
+    worker = worker or f'{socket.gethostname()}-{os.getpid()}'
+    manifest, prices = load_queue(queue_dir)
+    completed = 0
+
+    while True:
+        pending = [unit for unit in unit_names(queue_dir) if not is_done(queue_dir, unit) and not has_failed(queue_dir, unit)]
+        if not pending:
+            return completed
+
+        claimed = None
+        for unit in pending:
+            if claim_unit(queue_dir, unit, worker, stale_after):
+                claimed = unit
+                break
+        if claimed is None:
+            time.sleep(poll_interval)
+            continue
+
+        claim_path = os.path.join(queue_dir, 'claims', f'{claimed}.claim')
+        if is_done(queue_dir, claimed) or has_failed(queue_dir, claimed):
+            # another worker finished the unit after it was listed as pending, and released its claim
+            os.remove(claim_path)
+            continue
+        with open(os.path.join(queue_dir, 'units', f'{claimed}.json')) as f:
+            configs = json.load(f)
+        try:
+            with keep_claimed(claim_path, stale_after / 4):
+                results = run_unit(configs, prices, manifest['start_date'], manifest['start_value'], manifest.get('liquidity', 1e6))
+        except Exception:
+            error = f'{worker} failed on {claimed}:\n{traceback.format_exc()}'
+
+            def write_error(path):
+                with open(path, 'w') as f:
+                    f.write(error)
+            write_atomic(os.path.join(queue_dir, 'results', f'{claimed}.error'), write_error)
+            print(error)
+        else:
+            results['worker'] = worker
+            write_atomic(os.path.join(queue_dir, 'results', f'{claimed}.parquet'), lambda path: results.to_parquet(path, index=False))
+            completed += 1
+            print(f'{worker}: finished {claimed}')
+        try:
+            os.remove(claim_path)
+        except FileNotFoundError:
+            # the claim went stale and was taken over; the other worker writes the same result
+            pass
+
+
+def queue_status(queue_dir):
+    '''
+    Counts the units of a queue that are done, failed, claimed by a worker, or still waiting.
+    '''
+    units = unit_names(queue_dir)
+    done = [unit for unit in units if is_done(queue_dir, unit)]
+    failed = [unit for unit in units if unit not in done and has_failed(queue_dir, unit)]
+    claimed = [unit for unit in units if unit not in done and unit not in failed
+               and os.path.exists(os.path.join(queue_dir, 'claims', f'{unit}.claim'))]
+    return {'units': len(units), 'done': len(done), 'failed': len(failed), 'claimed': len(claimed),
+            'waiting': len(units) - len(done) - len(failed) - len(claimed)}
+
+
+def failed_units(queue_dir):
+    '''
+    Units without a result whose simulation raised an error, with the last line of the error.
+    '''
+    failed = {}
+    for unit in unit_names(queue_dir):
+        if not is_done(queue_dir, unit) and has_failed(queue_dir, unit):
+            with open(os.path.join(queue_dir, 'results', f'{unit}.error')) as f:
+                lines = f.read().strip().splitlines()
+            failed[unit] = lines[-1] if lines else ''
+    return failed
+
+
+def reduce_results(queue_dir, rank='roi', allow_failed=False):
+    '''
+    Merges all result shards into one leaderboard, best configuration first.
+    Raises an error if some units are still unfinished, or have failed unless allow_failed is set.
+    '''
+    status = queue_status(queue_dir)
+    if status['claimed'] or status['waiting']:
+        raise RuntimeError(f"Only {status['done']} of {status['units']} units are done, "
+                           f"{status['claimed']} are claimed and {status['waiting']} are waiting")
+    failed = failed_units(queue_dir)
+    if failed and not allow_failed:
+        details = '\n'.join(f'{unit}: {error}' for unit, error in failed.items())
+        raise RuntimeError(f'{len(failed)} of {status["units"]} units failed, see the .error files in results/:\n{details}')
+    if not status['done']:
+        raise RuntimeError('No units have a result')
+    shards = [pd.read_parquet(path) for path in sorted(glob.glob(os.path.join(queue_dir, 'results', 'unit-*.parquet')))]
+    leaderboard = pd.concat(shards, ignore_index=True)
+    return leaderboard.sort_values(by=[rank, 'id'], ascending=[RANK_ASCENDING.get(rank, False), True]).reset_index(drop=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run strategy sweeps over a file-based work queue.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    init = commands.add_parser('init', help='shard a sweep grid into work units')
+    init.add_argument('queue', help='queue directory, on a filesystem shared by all workers')
+    init.add_argument('--grid', required=True, help='JSON file with the sweep grid')
+    init.add_argument('--prices', default='data/prices.csv', help='price snapshot csv to pin (default: data/prices.csv)')
+    init.add_argument('--tokens', default='data/token_list.txt', help='token list used when the grid has no tokens (default: data/token_list.txt)')
+    init.add_argument('--unit-size', type=int, default=100, help='configurations per work unit (default: 100)')
+
+    worker = commands.add_parser('work', help='claim and run work units until the sweep is done')
+    worker.add_argument('queue', help='queue directory')
+    worker.add_argument('--stale-after', type=float, default=600, help='seconds without a refresh after which a claim is taken over (default: 600)')
+    worker.add_argument('--poll-interval', type=float, default=5, help='seconds between checks for stale claims (default: 5)')
+
+    status = commands.add_parser('status', help='show sweep progress')
+    status.add_argument('queue', help='queue directory')
+
+    reduce = commands.add_parser('reduce', help='merge result shards into a leaderboard')
+    reduce.add_argument('queue', help='queue directory')
+    reduce.add_argument('--rank', default='roi', help='metric to rank on (default: roi)')
+    reduce.add_argument('--out', default=None, help='leaderboard file, .csv or .parquet (default: <queue>/leaderboard.parquet)')
+    reduce.add_argument('--top', type=int, default=10, help='number of configurations to print (default: 10)')
+    reduce.add_argument('--allow-failed', action='store_true', help='merge the results of the other units if some units failed')
+    args = parser.parse_args(argv)
+
+    if args.command == 'init':
+        with open(args.grid) as f:
+            grid = json.load(f)
+        manifest = init_queue(args.queue, grid, load_snapshot(args.prices), load_tokens(args.tokens), args.unit_size)
+        print(f"Created {manifest['units']} units for {manifest['configs']} configurations in {args.queue}")
+
+    elif args.command == 'work':
+        completed = work(args.queue, stale_after=args.stale_after, poll_interval=args.poll_interval)
+        print(f'Sweep done, this worker completed {completed} units')
+
+    elif args.command == 'status':
+        print(queue_status(args.queue))
+        for unit, error in failed_units(args.queue).items():
+            print(f'{unit} failed: {error}')
+
+    elif args.command == 'reduce':
+        leaderboard = reduce_results(args.queue, args.rank, args.allow_failed)
+        out = args.out or os.path.join(args.queue, 'leaderboard.parquet')
+        if out.endswith('.csv'):
+            leaderboard.to_csv(out, index=False)
+        else:
+            leaderboard.to_parquet(out, index=False)
+        print(leaderboard.head(args.top).to_string())
+        print(f'Leaderboard of {leaderboard.shape[0]} configurations written to {out}')
+
+
+if __name__ == '__main__':
+    main()